@@ -3,15 +3,52 @@ Lytir.io Backend API
 A forecasting platform backend built with Flask
 """
 
-from flask import Flask, request, jsonify, session
+from flask import Flask, request, jsonify, session, make_response
+from flask.json.provider import JSONProvider
 from flask_cors import CORS
+from flask_caching import Cache
+from flask_compress import Compress
 from werkzeug.security import generate_password_hash, check_password_hash
-from datetime import datetime, timedelta
-import sqlite3
+from datetime import datetime, timedelta, timezone
+from contextlib import contextmanager
+import apsw
+import atexit
+import queue
+import re
+import orjson
 import os
+import threading
+import time
+import uuid
 from functools import wraps
 
+try:
+    from gevent.monkey import is_module_patched
+except ImportError:  # gevent is only needed when served by gunicorn's gevent worker
+    def is_module_patched(module):
+        return False
+
+if is_module_patched('threading'):
+    # Real OS threads, so CPU-bound work doesn't stall the event loop
+    from gevent.threadpool import ThreadPoolExecutor
+else:
+    from concurrent.futures import ThreadPoolExecutor
+
+class ORJSONProvider(JSONProvider):
+    """Serialize JSON with orjson instead of the stdlib json module"""
+    
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj).decode()
+    
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+    
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(orjson.dumps(obj), mimetype='application/json')
+
 app = Flask(__name__)
+app.json = ORJSONProvider(app)
 app.secret_key = os.environ.get('SECRET_KEY', 'lytir.io')
 
 # Configure CORS - UPDATE THIS WITH YOUR FRONTEND URL WHEN DEPLOYING
@@ -22,10 +59,151 @@ CORS(app, supports_credentials=True, origins=[
     'https://your-frontend-url.netlify.app',  # Or this!
 ])
 
+# Compress JSON responses, preferring brotli
+app.config.update(
+    COMPRESS_MIMETYPES=['application/json'],
+    COMPRESS_LEVEL=4,
+    COMPRESS_BR_LEVEL=4,
+    COMPRESS_MIN_SIZE=512,
+    COMPRESS_ALGORITHM=['br', 'gzip'],
+)
+Compress(app)
+
+# In-process cache for read-heavy public endpoints
+cache = Cache(app, config={'CACHE_TYPE': 'SimpleCache', 'CACHE_DEFAULT_TIMEOUT': 15})
+MARKETS_CACHE_KEY = 'view//api/markets'
+
+# Per-user /api/user payloads, keyed by user id
+# They hold the token balance, so a write in one gunicorn worker must invalidate
+# them for every worker: the cache lives on disk, shared by all workers.
+USER_CACHE_DIR = os.environ.get('USER_CACHE_DIR', 'user-cache')
+USER_CACHE_KEY = 'user:{}'
+USER_CACHE_TTL = 30
+user_cache = Cache(app, config={'CACHE_TYPE': 'FileSystemCache', 'CACHE_DIR': USER_CACHE_DIR,
+                                'CACHE_DEFAULT_TIMEOUT': USER_CACHE_TTL})
+
+# Password hashing
+# Half of Werkzeug's default scrypt cost; existing hashes still verify with their own parameters.
+# The KDF releases the GIL and runs on a bounded pool so concurrent logins can't exhaust memory.
+PASSWORD_HASH_METHOD = 'scrypt:16384:8:1'
+
+_hash_executor = ThreadPoolExecutor(max_workers=os.cpu_count() or 1, thread_name_prefix='password-hash')
+
+def hash_password(password):
+    return _hash_executor.submit(generate_password_hash, password, method=PASSWORD_HASH_METHOD).result()
+
+def verify_password(password_hash, password):
+    return _hash_executor.submit(check_password_hash, password_hash, password).result()
+
+# Database connection pool
+# apsw is a thin wrapper over SQLite with its own statement cache. It bundles its own
+# SQLite library, so the stdlib sqlite3 module must not open the same file in this
+# process. Connections are opened once and reused across requests; they are never closed.
+DB_PATH = 'lytir.db'
+# Under gevent, apsw calls never yield to the hub, so a worker only has a connection
+# or two busy at once; every idle handle still holds its page cache and mmap.
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE',
+                                  4 if is_module_patched('threading') else min(32, (os.cpu_count() or 1) * 4)))
+DB_OPTIMIZE_INTERVAL = 3600  # seconds between PRAGMA optimize runs
+MAX_ROWID = 2**63 - 1
+MAX_PAGE_SIZE = 100
+
+def _connect():
+    conn = apsw.Connection(DB_PATH, statementcachesize=256)
+    conn.set_busy_timeout(5000)
+    conn.execute('''PRAGMA journal_mode=WAL;
+                    PRAGMA synchronous=NORMAL;
+                    PRAGMA temp_store=MEMORY;
+                    PRAGMA cache_size=-64000;
+                    PRAGMA mmap_size=268435456;''').fetchall()
+    return conn
+
+_pool = queue.Queue(maxsize=DB_POOL_SIZE)
+for _ in range(DB_POOL_SIZE):
+    _pool.put(_connect())
+_last_optimize = time.monotonic()
+
+# SQL statements
+# Shared by every call site so each execute() passes the identical string and
+# hits the connection's prepared-statement cache.
+SQL_INSERT_PENDING_FORECAST = '''INSERT OR IGNORE INTO forecasts (user_id, market_id, probability, tokens_spent, idempotency_key)
+                                 SELECT ?, m.id, ?, ?, ? FROM markets m, users u
+                                 WHERE m.id = ? AND m.status = 'active' AND u.id = ? AND u.tokens >= ?'''
+SQL_CHARGE_PENDING_FORECAST = 'UPDATE users SET tokens = tokens - ? WHERE id = ?'
+SQL_FIND_EXISTING_USER = 'SELECT id FROM users WHERE email = ? OR username = ?'
+SQL_INSERT_USER = 'INSERT INTO users (username, email, password_hash) VALUES (?, ?, ?)'
+SQL_GET_NEW_USER = 'SELECT id, username, email, tokens FROM users WHERE id = ?'
+SQL_GET_USER_BY_EMAIL = 'SELECT * FROM users WHERE email = ?'
+SQL_GET_USER = '''SELECT u.id, u.username, u.email, u.tokens,
+                         (SELECT COUNT(*) FROM forecasts WHERE user_id = u.id) as forecasts_count,
+                         COALESCE((SELECT ROUND(100 * (1 - AVG(brier)), 0) FROM forecasts
+                                   WHERE user_id = u.id AND brier IS NOT NULL), 0) as accuracy,
+                         (SELECT COUNT(*) + 1 FROM users u2 WHERE u2.tokens > u.tokens) as rank
+                  FROM users u
+                  WHERE u.id = ?'''
+SQL_GET_USER_FORECASTS = '''SELECT f.id, f.user_id, f.market_id, f.probability, f.tokens_spent, f.reward, f.created_at,
+                                   m.question as market_question, m.status, m.category,
+                                   ROUND(s.sum_prob / s.cnt, 0) as crowd_prediction
+                            FROM forecasts f
+                            JOIN markets m ON f.market_id = m.id
+                            LEFT JOIN market_stats s ON s.market_id = f.market_id
+                            WHERE f.user_id = ? AND f.id < ?
+                            ORDER BY f.id DESC
+                            LIMIT ?'''
+SQL_GET_ACTIVE_MARKETS = '''SELECT m.*,
+                                   COALESCE(ROUND(s.sum_prob / s.cnt, 0), 50) as crowd_prediction,
+                                   COALESCE(s.cnt, 0) as forecasts_count
+                            FROM markets m
+                            LEFT JOIN market_stats s ON s.market_id = m.id
+                            WHERE m.status = 'active'
+                            ORDER BY m.created_at DESC'''
+SQL_GET_MARKET = 'SELECT * FROM markets WHERE id = ?'
+SQL_GET_CROWD_PREDICTION = 'SELECT sum_prob / cnt, cnt FROM market_stats WHERE market_id = ?'
+SQL_GET_RECENT_FORECASTS = '''SELECT f.id, f.probability, f.created_at, u.username
+                              FROM forecasts f
+                              JOIN users u ON f.user_id = u.id
+                              WHERE f.market_id = ? AND f.id < ?
+                              ORDER BY f.id DESC
+                              LIMIT ?'''
+SQL_GET_MARKET_STATUS = 'SELECT status FROM markets WHERE id = ?'
+SQL_FIND_FORECAST_BY_KEY = 'SELECT 1 FROM forecasts WHERE user_id = ? AND idempotency_key = ?'
+SQL_GET_FORECAST_BY_KEY = '''SELECT id, market_id, probability, tokens_spent, created_at
+                             FROM forecasts WHERE user_id = ? AND idempotency_key = ?'''
+SQL_GET_USER_TOKENS = 'SELECT tokens FROM users WHERE id = ?'
+SQL_GET_LEADERBOARD = '''SELECT u.id, u.username, u.tokens,
+                                COUNT(f.id) as forecasts_count,
+                                COALESCE(ROUND(100 * (1 - AVG(f.brier)), 0), 0) as accuracy
+                         FROM users u
+                         LEFT JOIN forecasts f ON f.user_id = u.id
+                         GROUP BY u.id
+                         ORDER BY u.tokens DESC
+                         LIMIT 50'''
+SQL_RESOLVE_MARKET = 'UPDATE markets SET status = ?, outcome = ? WHERE id = ?'
+SQL_SET_REWARDS = '''UPDATE forecasts
+                     SET reward = CAST((CASE WHEN :outcome = 1 THEN probability
+                                             ELSE 100 - probability END) * 0.5 AS INTEGER),
+                         brier = (probability / 100.0 - :outcome) * (probability / 100.0 - :outcome)
+                     WHERE market_id = :market_id'''
+SQL_PAY_REWARDS = '''UPDATE users
+                     SET tokens = tokens + (SELECT SUM(reward) FROM forecasts
+                                            WHERE forecasts.user_id = users.id
+                                              AND forecasts.market_id = ?)
+                     WHERE id IN (SELECT user_id FROM forecasts WHERE market_id = ?)'''
+SQL_GET_MARKET_FORECASTERS = 'SELECT DISTINCT user_id FROM forecasts WHERE market_id = ?'
+
+def add_missing_column(c, table, column, definition):
+    """Add a column to tables created before it existed; returns True if it was added"""
+    c.execute(f'PRAGMA table_info({table})')
+    if column in [row[1] for row in c.fetchall()]:
+        return False
+    c.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+    return True
+
 # Database initialization
 def init_db():
-    conn = sqlite3.connect('lytir.db')
+    conn = apsw.Connection(DB_PATH)
     c = conn.cursor()
+    c.execute('BEGIN')
     
     # Users table
     c.execute('''CREATE TABLE IF NOT EXISTS users
@@ -44,8 +222,12 @@ def init_db():
                   category TEXT,
                   resolution_date TEXT,
                   status TEXT DEFAULT 'active',
+                  outcome INTEGER,
                   created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
     
+    # Outcome (1 = yes, 0 = no) is recorded on resolution
+    add_missing_column(c, 'markets', 'outcome', 'INTEGER')
+    
     # Forecasts table
     c.execute('''CREATE TABLE IF NOT EXISTS forecasts
                  (id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -54,11 +236,49 @@ def init_db():
                   probability REAL NOT NULL,
                   tokens_spent INTEGER DEFAULT 10,
                   reward INTEGER DEFAULT 0,
+                  idempotency_key TEXT,
+                  brier REAL,
                   created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                   FOREIGN KEY (user_id) REFERENCES users(id),
                   FOREIGN KEY (market_id) REFERENCES markets(id))''')
     
-    conn.commit()
+    add_missing_column(c, 'forecasts', 'idempotency_key', 'TEXT')
+    
+    # Brier score, stored when the market resolves; backfill already resolved markets
+    if add_missing_column(c, 'forecasts', 'brier', 'REAL'):
+        c.execute('''UPDATE forecasts
+                     SET brier = (SELECT (probability / 100.0 - m.outcome) * (probability / 100.0 - m.outcome)
+                                  FROM markets m WHERE m.id = forecasts.market_id)
+                     WHERE market_id IN (SELECT id FROM markets WHERE outcome IS NOT NULL)''')
+    
+    # Per-market probability sum and forecast count, kept current by the trigger below
+    c.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'market_stats'")
+    if c.fetchone() is None:
+        c.execute('''CREATE TABLE market_stats
+                     (market_id INTEGER PRIMARY KEY,
+                      sum_prob REAL DEFAULT 0,
+                      cnt INTEGER DEFAULT 0)''')
+        c.execute('''INSERT INTO market_stats (market_id, sum_prob, cnt)
+                     SELECT market_id, SUM(probability), COUNT(*) FROM forecasts GROUP BY market_id''')
+    
+    # Forecasts are never updated or deleted, so an insert trigger is enough
+    c.execute('''CREATE TRIGGER IF NOT EXISTS forecasts_after_insert AFTER INSERT ON forecasts
+                 BEGIN
+                     INSERT INTO market_stats (market_id, sum_prob, cnt)
+                     VALUES (NEW.market_id, NEW.probability, 1)
+                     ON CONFLICT(market_id) DO UPDATE SET sum_prob = sum_prob + NEW.probability,
+                                                          cnt = cnt + 1;
+                 END''')
+    
+    # Indexes
+    # idx_forecasts_user_market also serves lookups on user_id alone
+    c.execute('CREATE INDEX IF NOT EXISTS idx_forecasts_user_market ON forecasts(user_id, market_id)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_forecasts_market ON forecasts(market_id)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_users_tokens ON users(tokens DESC)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_markets_status_created ON markets(status, created_at DESC)')
+    # Idempotency keys are chosen by the client, so they are only unique per user
+    c.execute('DROP INDEX IF EXISTS idx_forecasts_idempotency_key')
+    c.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_forecasts_user_idempotency_key ON forecasts(user_id, idempotency_key)')
     
     # Add sample markets if none exist
     c.execute('SELECT COUNT(*) FROM markets')
@@ -76,9 +296,17 @@ def init_db():
         ]
         c.executemany('INSERT INTO markets (question, description, category, resolution_date) VALUES (?, ?, ?, ?)',
                      sample_markets)
-        conn.commit()
+        
+        # Give a new database planner statistics so the indexes above get picked;
+        # existing ones are kept current by the periodic PRAGMA optimize in get_db
+        c.execute('ANALYZE')
+    
+    c.execute('COMMIT')
     
     conn.close()
+    
+    # Payloads left on disk by a previous run may describe a different database
+    user_cache.clear()
 
 # Authentication decorator
 def login_required(f):
@@ -89,49 +317,151 @@ def login_required(f):
         return f(*args, **kwargs)
     return decorated_function
 
+# Conditional GET decorator
+# Flask-Compress suffixes strong ETags with the encoding ("<hash>:br"), and
+# clients send that back; compare against the bare hash set by the view.
+ETAG_ENCODING_SUFFIX = re.compile(r':(?:br|gzip)"')
+
+def conditional(f):
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        # Answer If-None-Match with 304 using the ETag set by the view
+        response = make_response(f(*args, **kwargs))
+        
+        environ = request.environ
+        if_none_match = environ.get('HTTP_IF_NONE_MATCH')
+        if if_none_match:
+            environ = dict(environ, HTTP_IF_NONE_MATCH=ETAG_ENCODING_SUFFIX.sub('"', if_none_match))
+        response.make_conditional(environ)
+        
+        if response.status_code == 304:
+            # Echo the encoded validator the client holds, as the 200 carried it
+            etag, _ = response.get_etag()
+            for tag in request.if_none_match.as_set():
+                if tag.rsplit(':', 1)[0] == etag:
+                    response.set_etag(tag)
+                    break
+        return response
+    return decorated_function
+
 # Helper functions
+def clear_public_caches():
+    """Drop cached market and leaderboard responses after a write"""
+    cache.delete_many(MARKETS_CACHE_KEY, 'view//api/leaderboard')
+
+def fetch_dict(c):
+    """Next row of c as a dict keyed by column name, or None"""
+    row = c.fetchone()
+    if row is None:
+        return None
+    return dict(zip([column[0] for column in c.description], row))
+
+def fetch_dicts(c):
+    """Remaining rows of c as dicts; column names are read once per result set"""
+    try:
+        columns = [column[0] for column in c.description]
+    except apsw.ExecutionCompleteError:
+        return []  # The query returned no rows
+    return [dict(zip(columns, row)) for row in c]
+
+def get_page_args(default_limit):
+    """Read ?limit= and the ?before= keyset cursor (a forecast id) from the query string"""
+    limit = min(max(request.args.get('limit', default_limit, type=int), 1), MAX_PAGE_SIZE)
+    # Clamped to SQLite's integer range; larger values can't be bound as a parameter
+    before = min(max(request.args.get('before', MAX_ROWID, type=int), 0), MAX_ROWID)
+    return limit, before
+
+def next_cursor(rows, limit):
+    """Id to pass as ?before= for the next page, or None on the last page"""
+    return rows[-1]['id'] if len(rows) == limit else None
+
+@contextmanager
 def get_db():
-    conn = sqlite3.connect('lytir.db')
-    conn.row_factory = sqlite3.Row
-    return conn
+    conn = _pool.get()
+    try:
+        yield conn
+    finally:
+        global _last_optimize
+        # Never hand a connection back to the pool mid-transaction
+        if conn.in_transaction:
+            conn.execute('ROLLBACK')
+        # Planner statistics are database-wide, so any returning connection can refresh them
+        if time.monotonic() - _last_optimize > DB_OPTIMIZE_INTERVAL:
+            _last_optimize = time.monotonic()
+            conn.execute('PRAGMA optimize')
+        _pool.put(conn)
 
-def calculate_crowd_prediction(market_id):
+def calculate_crowd_prediction(conn, market_id):
     """Calculate average prediction for a market"""
-    conn = get_db()
     c = conn.cursor()
-    c.execute('''SELECT AVG(probability) as avg_prob, COUNT(*) as count 
-                 FROM forecasts WHERE market_id = ?''', (market_id,))
-    result = c.fetchone()
-    conn.close()
+    c.execute(SQL_GET_CROWD_PREDICTION, (market_id,))
+    row = c.fetchone()
     
-    if result and result['count'] > 0:
-        return round(result['avg_prob'], 0), result['count']
+    if row is not None and row[1] > 0:
+        avg_prob, count = row
+        return round(avg_prob, 0), count
     return 50, 0  # Default if no forecasts
 
-def calculate_user_accuracy(user_id):
-    """Calculate user's forecasting accuracy"""
-    conn = get_db()
-    c = conn.cursor()
-    
-    # Get resolved forecasts with their markets
-    c.execute('''SELECT f.probability, m.status 
-                 FROM forecasts f 
-                 JOIN markets m ON f.market_id = m.id 
-                 WHERE f.user_id = ? AND m.status = 'resolved' ''', (user_id,))
-    
-    forecasts = c.fetchall()
-    conn.close()
-    
-    if not forecasts:
-        return 0
-    
-    # Simple accuracy calculation (can be improved with Brier score)
-    total_accuracy = 0
-    for forecast in forecasts:
-        # Placeholder: In real implementation, compare with actual outcome
-        total_accuracy += abs(100 - forecast['probability'])
-    
-    return round(100 - (total_accuracy / len(forecasts)), 0)
+# Forecast write coalescing
+# Submitted forecasts are buffered and written by a background thread in one
+# transaction per interval. The lock is held through each flush's commit, so
+# a balance read under it plus the pending deductions is current for this
+# process. The flush still re-checks market status, balance and the user's
+# idempotency key row by row against the database, because a market can be
+# resolved before its forecasts are written and other gunicorn workers buffer
+# their own forecasts. Tokens are only charged for rows that were written.
+FORECAST_FLUSH_INTERVAL = 0.05  # seconds
+
+_pending_forecasts = []  # (user_id, market_id, probability, tokens_spent, idempotency_key)
+_pending_lock = threading.Lock()
+_writer_started = False
+
+def flush_forecasts():
+    """Write buffered forecasts and their token deductions in one transaction"""
+    if not _pending_forecasts:
+        return
+    
+    # Always take the connection before the lock, like submit_forecast does
+    with get_db() as conn:
+        with _pending_lock:
+            batch = list(_pending_forecasts)
+            if not batch:
+                return
+            
+            c = conn.cursor()
+            c.execute('BEGIN IMMEDIATE')
+            
+            for user_id, market_id, probability, tokens_spent, key in batch:
+                # Skipped if the market was resolved, the balance ran out or the user already used the key
+                c.execute(SQL_INSERT_PENDING_FORECAST,
+                          (user_id, probability, tokens_spent, key, market_id, user_id, tokens_spent))
+                # Only charge for forecasts that were written
+                if conn.changes():
+                    c.execute(SQL_CHARGE_PENDING_FORECAST, (tokens_spent, user_id))
+            
+            c.execute('COMMIT')
+            # Keep the batch buffered until it is committed so a failed flush is retried
+            del _pending_forecasts[:len(batch)]
+    
+    clear_public_caches()
+    user_cache.delete_many(*{USER_CACHE_KEY.format(forecast[0]) for forecast in batch})
+
+def _forecast_writer():
+    while True:
+        time.sleep(FORECAST_FLUSH_INTERVAL)
+        try:
+            flush_forecasts()
+        except Exception:
+            app.logger.exception('Failed to flush forecasts')
+
+def start_forecast_writer():
+    global _writer_started
+    with _pending_lock:
+        if _writer_started:
+            return
+        _writer_started = True
+    threading.Thread(target=_forecast_writer, name='forecast-writer', daemon=True).start()
+    atexit.register(flush_forecasts)
 
 # ========================================
 # AUTHENTICATION ENDPOINTS
@@ -147,25 +477,28 @@ def signup():
     if not all([username, email, password]):
         return jsonify({'error': 'All fields required'}), 400
     
-    conn = get_db()
-    c = conn.cursor()
+    # Hash before taking the write lock
+    password_hash = hash_password(password)
     
-    # Check if user exists
-    c.execute('SELECT id FROM users WHERE email = ? OR username = ?', (email, username))
-    if c.fetchone():
-        conn.close()
-        return jsonify({'error': 'User already exists'}), 400
-    
-    # Create user
-    password_hash = generate_password_hash(password)
-    c.execute('INSERT INTO users (username, email, password_hash) VALUES (?, ?, ?)',
-              (username, email, password_hash))
-    conn.commit()
-    user_id = c.lastrowid
-    
-    c.execute('SELECT id, username, email, tokens FROM users WHERE id = ?', (user_id,))
-    user = dict(c.fetchone())
-    conn.close()
+    with get_db() as conn:
+        c = conn.cursor()
+        c.execute('BEGIN IMMEDIATE')
+        
+        # Check if user exists
+        c.execute(SQL_FIND_EXISTING_USER, (email, username))
+        if c.fetchone():
+            return jsonify({'error': 'User already exists'}), 400
+        
+        # Create user
+        c.execute(SQL_INSERT_USER, (username, email, password_hash))
+        user_id = conn.last_insert_rowid()
+        
+        c.execute(SQL_GET_NEW_USER, (user_id,))
+        user = fetch_dict(c)
+        
+        c.execute('COMMIT')
+    
+    clear_public_caches()
     
     # Set session
     session['user_id'] = user_id
@@ -185,13 +518,12 @@ def login():
     if not all([email, password]):
         return jsonify({'error': 'Email and password required'}), 400
     
-    conn = get_db()
-    c = conn.cursor()
-    c.execute('SELECT * FROM users WHERE email = ?', (email,))
-    user = c.fetchone()
-    conn.close()
+    with get_db() as conn:
+        c = conn.cursor()
+        c.execute(SQL_GET_USER_BY_EMAIL, (email,))
+        user = fetch_dict(c)
     
-    if not user or not check_password_hash(user['password_hash'], password):
+    if not user or not verify_password(user['password_hash'], password):
         return jsonify({'error': 'Invalid credentials'}), 401
     
     # Set session
@@ -210,7 +542,8 @@ def login():
 
 @app.route('/api/logout', methods=['POST'])
 def logout():
-    session.pop('user_id', None)
+    user_id = session.pop('user_id', None)
+    user_cache.delete(USER_CACHE_KEY.format(user_id))
     return jsonify({'message': 'Logged out successfully'}), 200
 
 # ========================================
@@ -222,26 +555,18 @@ def logout():
 def get_user():
     user_id = session['user_id']
     
-    conn = get_db()
-    c = conn.cursor()
-    
-    # Get user data
-    c.execute('SELECT id, username, email, tokens FROM users WHERE id = ?', (user_id,))
-    user = dict(c.fetchone())
-    
-    # Get forecasts count
-    c.execute('SELECT COUNT(*) as count FROM forecasts WHERE user_id = ?', (user_id,))
-    user['forecasts_count'] = c.fetchone()['count']
+    user = user_cache.get(USER_CACHE_KEY.format(user_id))
+    if user is not None:
+        return jsonify(user), 200
     
-    # Calculate accuracy
-    user['accuracy'] = calculate_user_accuracy(user_id)
-    
-    # Calculate rank (simple implementation)
-    c.execute('''SELECT COUNT(*) + 1 as rank FROM users 
-                 WHERE tokens > (SELECT tokens FROM users WHERE id = ?)''', (user_id,))
-    user['rank'] = c.fetchone()['rank']
+    with get_db() as conn:
+        c = conn.cursor()
+        
+        # Profile, forecast count, accuracy (100 * (1 - mean Brier score)) and rank in one query
+        c.execute(SQL_GET_USER, (user_id,))
+        user = fetch_dict(c)
     
-    conn.close()
+    user_cache.set(USER_CACHE_KEY.format(user_id), user)
     
     return jsonify(user), 200
 
@@ -249,79 +574,61 @@ def get_user():
 @login_required
 def get_user_forecasts():
     user_id = session['user_id']
+    limit, before = get_page_args(default_limit=50)
     
-    conn = get_db()
-    c = conn.cursor()
-    c.execute('''SELECT f.*, m.question as market_question, m.status, m.category
-                 FROM forecasts f
-                 JOIN markets m ON f.market_id = m.id
-                 WHERE f.user_id = ?
-                 ORDER BY f.created_at DESC''', (user_id,))
-    
-    forecasts = []
-    for row in c.fetchall():
-        forecast = dict(row)
-        # Get crowd prediction for this market
-        crowd_pred, _ = calculate_crowd_prediction(forecast['market_id'])
-        forecast['crowd_prediction'] = crowd_pred
-        forecasts.append(forecast)
-    
-    conn.close()
+    with get_db() as conn:
+        c = conn.cursor()
+        # Newest first, one page at a time
+        c.execute(SQL_GET_USER_FORECASTS, (user_id, before, limit))
+        
+        forecasts = fetch_dicts(c)
     
-    return jsonify(forecasts), 200
+    return jsonify({
+        'forecasts': forecasts,
+        'next_cursor': next_cursor(forecasts, limit)
+    }), 200
 
 # ========================================
 # MARKET ENDPOINTS
 # ========================================
 
 @app.route('/api/markets', methods=['GET'])
+@conditional
+@cache.cached(timeout=15)
 def get_markets():
-    conn = get_db()
-    c = conn.cursor()
-    c.execute('SELECT * FROM markets WHERE status = "active" ORDER BY created_at DESC')
-    
-    markets = []
-    for row in c.fetchall():
-        market = dict(row)
-        # Add crowd prediction and forecast count
-        crowd_pred, forecast_count = calculate_crowd_prediction(market['id'])
-        market['crowd_prediction'] = crowd_pred
-        market['forecasts_count'] = forecast_count
-        markets.append(market)
-    
-    conn.close()
+    with get_db() as conn:
+        c = conn.cursor()
+        # Crowd prediction and forecast count in the same query as the markets
+        c.execute(SQL_GET_ACTIVE_MARKETS)
+        
+        markets = fetch_dicts(c)
     
-    return jsonify(markets), 200
+    response = jsonify(markets)
+    response.add_etag()
+    return response
 
 @app.route('/api/markets/<int:market_id>', methods=['GET'])
 def get_market(market_id):
-    conn = get_db()
-    c = conn.cursor()
-    c.execute('SELECT * FROM markets WHERE id = ?', (market_id,))
-    market_row = c.fetchone()
-    
-    if not market_row:
-        conn.close()
-        return jsonify({'error': 'Market not found'}), 404
-    
-    market = dict(market_row)
+    limit, before = get_page_args(default_limit=10)
     
-    # Add crowd prediction and forecast count
-    crowd_pred, forecast_count = calculate_crowd_prediction(market_id)
-    market['crowd_prediction'] = crowd_pred
-    market['forecasts_count'] = forecast_count
-    
-    # Get recent forecasts
-    c.execute('''SELECT f.probability, f.created_at, u.username
-                 FROM forecasts f
-                 JOIN users u ON f.user_id = u.id
-                 WHERE f.market_id = ?
-                 ORDER BY f.created_at DESC
-                 LIMIT 10''', (market_id,))
-    
-    market['recent_forecasts'] = [dict(row) for row in c.fetchall()]
-    
-    conn.close()
+    with get_db() as conn:
+        c = conn.cursor()
+        c.execute(SQL_GET_MARKET, (market_id,))
+        market = fetch_dict(c)
+        
+        if not market:
+            return jsonify({'error': 'Market not found'}), 404
+        
+        # Add crowd prediction and forecast count
+        crowd_pred, forecast_count = calculate_crowd_prediction(conn, market_id)
+        market['crowd_prediction'] = crowd_pred
+        market['forecasts_count'] = forecast_count
+        
+        # Get recent forecasts
+        c.execute(SQL_GET_RECENT_FORECASTS, (market_id, before, limit))
+        
+        market['recent_forecasts'] = fetch_dicts(c)
+        market['next_cursor'] = next_cursor(market['recent_forecasts'], limit)
     
     return jsonify(market), 200
 
@@ -344,69 +651,90 @@ def submit_forecast():
     if not 0 <= probability <= 100:
         return jsonify({'error': 'Probability must be between 0 and 100'}), 400
     
-    conn = get_db()
-    c = conn.cursor()
-    
-    # Check if market exists and is active
-    c.execute('SELECT status FROM markets WHERE id = ?', (market_id,))
-    market = c.fetchone()
-    if not market:
-        conn.close()
-        return jsonify({'error': 'Market not found'}), 404
-    
-    if market['status'] != 'active':
-        conn.close()
-        return jsonify({'error': 'Market is not active'}), 400
+    # Retried submissions with the same key are only recorded once
+    idempotency_key = request.headers.get('Idempotency-Key') or uuid.uuid4().hex
     
-    # Check user has enough tokens
-    c.execute('SELECT tokens FROM users WHERE id = ?', (user_id,))
-    user = c.fetchone()
-    tokens_cost = 10
+    with get_db() as conn:
+        c = conn.cursor()
+        
+        # Check if market exists and is active
+        c.execute(SQL_GET_MARKET_STATUS, (market_id,))
+        market = c.fetchone()
+        if not market:
+            return jsonify({'error': 'Market not found'}), 404
+        
+        if market[0] != 'active':
+            return jsonify({'error': 'Market is not active'}), 400
+        
+        tokens_cost = 10
+        
+        with _pending_lock:
+            c.execute(SQL_FIND_FORECAST_BY_KEY, (user_id, idempotency_key))
+            duplicate = c.fetchone() or any(forecast[0] == user_id and forecast[4] == idempotency_key
+                                            for forecast in _pending_forecasts)
+            
+            if not duplicate:
+                # Check user has enough tokens, counting forecasts not yet written
+                c.execute(SQL_GET_USER_TOKENS, (user_id,))
+                tokens, = c.fetchone()
+                pending_cost = sum(forecast[3] for forecast in _pending_forecasts
+                                   if forecast[0] == user_id)
+                
+                if tokens - pending_cost < tokens_cost:
+                    return jsonify({'error': 'Insufficient tokens'}), 400
+                
+                _pending_forecasts.append((user_id, market_id, probability, tokens_cost, idempotency_key))
+    
+    start_forecast_writer()
     
-    if user['tokens'] < tokens_cost:
-        conn.close()
-        return jsonify({'error': 'Insufficient tokens'}), 400
+    return jsonify({
+        'message': 'Forecast accepted',
+        'idempotency_key': idempotency_key
+    }), 202
+
+@app.route('/api/forecast/<idempotency_key>', methods=['GET'])
+@login_required
+def get_forecast_status(idempotency_key):
+    """Whether an accepted forecast is still buffered or has been written"""
+    user_id = session['user_id']
     
-    # Create forecast
-    c.execute('''INSERT INTO forecasts (user_id, market_id, probability, tokens_spent)
-                 VALUES (?, ?, ?, ?)''', (user_id, market_id, probability, tokens_cost))
+    with _pending_lock:
+        pending = any(forecast[0] == user_id and forecast[4] == idempotency_key
+                      for forecast in _pending_forecasts)
+    if pending:
+        return jsonify({'status': 'pending'}), 200
     
-    # Deduct tokens
-    c.execute('UPDATE users SET tokens = tokens - ? WHERE id = ?', (tokens_cost, user_id))
+    with get_db() as conn:
+        c = conn.cursor()
+        c.execute(SQL_GET_FORECAST_BY_KEY, (user_id, idempotency_key))
+        forecast = fetch_dict(c)
     
-    conn.commit()
-    forecast_id = c.lastrowid
-    conn.close()
+    # Not found means the flush dropped it (market resolved or balance spent),
+    # or it is still buffered by another worker
+    if not forecast:
+        return jsonify({'error': 'Forecast not found'}), 404
     
-    return jsonify({
-        'message': 'Forecast submitted successfully',
-        'forecast_id': forecast_id
-    }), 201
+    return jsonify({'status': 'recorded', 'forecast': forecast}), 200
 
 # ========================================
 # LEADERBOARD ENDPOINT
 # ========================================
 
 @app.route('/api/leaderboard', methods=['GET'])
+@conditional
+@cache.cached(timeout=30)
 def get_leaderboard():
-    conn = get_db()
-    c = conn.cursor()
-    
-    c.execute('''SELECT id, username, tokens, 
-                 (SELECT COUNT(*) FROM forecasts WHERE user_id = users.id) as forecasts_count
-                 FROM users
-                 ORDER BY tokens DESC
-                 LIMIT 50''')
-    
-    leaderboard = []
-    for row in c.fetchall():
-        user = dict(row)
-        user['accuracy'] = calculate_user_accuracy(user['id'])
-        leaderboard.append(user)
-    
-    conn.close()
+    with get_db() as conn:
+        c = conn.cursor()
+        
+        # Forecast counts and accuracy for every user in one aggregate query
+        c.execute(SQL_GET_LEADERBOARD)
+        
+        leaderboard = fetch_dicts(c)
     
-    return jsonify(leaderboard), 200
+    response = jsonify(leaderboard)
+    response.add_etag()
+    return response
 
 # ========================================
 # ADMIN ENDPOINTS (for testing)
@@ -422,35 +750,32 @@ def resolve_market():
     if not all([market_id, outcome]):
         return jsonify({'error': 'Market ID and outcome required'}), 400
     
-    conn = get_db()
-    c = conn.cursor()
-    
-    # Update market status
-    c.execute('UPDATE markets SET status = ? WHERE id = ?', ('resolved', market_id))
+    if outcome not in ('yes', 'no'):
+        return jsonify({'error': "Outcome must be 'yes' or 'no'"}), 400
     
-    # Calculate rewards for forecasters
-    c.execute('SELECT * FROM forecasts WHERE market_id = ?', (market_id,))
-    forecasts = c.fetchall()
-    
-    for forecast in forecasts:
-        # Simple reward calculation based on accuracy
-        if outcome == 'yes':
-            accuracy = forecast['probability']
-        else:
-            accuracy = 100 - forecast['probability']
+    with get_db() as conn:
+        c = conn.cursor()
+        c.execute('BEGIN IMMEDIATE')
+        
+        outcome_value = 1 if outcome == 'yes' else 0
         
-        # Calculate reward (more accurate = more tokens)
-        reward = int(accuracy * 0.5)  # Max 50 tokens for perfect prediction
+        # Update market status
+        c.execute(SQL_RESOLVE_MARKET, ('resolved', outcome_value, market_id))
         
-        # Update forecast reward
-        c.execute('UPDATE forecasts SET reward = ? WHERE id = ?', (reward, forecast['id']))
+        # Reward forecasters in proportion to accuracy (max 50 tokens for a perfect prediction)
+        # and store each forecast's Brier score for accuracy reads
+        c.execute(SQL_SET_REWARDS, {'outcome': outcome_value, 'market_id': market_id})
         
-        # Give tokens to user
-        c.execute('UPDATE users SET tokens = tokens + ? WHERE id = ?', 
-                 (reward, forecast['user_id']))
+        # Give tokens to users
+        c.execute(SQL_PAY_REWARDS, (market_id, market_id))
+        
+        c.execute(SQL_GET_MARKET_FORECASTERS, (market_id,))
+        rewarded_users = [user_id for user_id, in c.fetchall()]
+        
+        c.execute('COMMIT')
     
-    conn.commit()
-    conn.close()
+    clear_public_caches()
+    user_cache.delete_many(*(USER_CACHE_KEY.format(user_id) for user_id in rewarded_users))
     
     return jsonify({'message': 'Market resolved successfully'}), 200
 
@@ -458,33 +783,46 @@ def resolve_market():
 # HEALTH CHECK
 # ========================================
 
+# (unix second, encoded body) of the last health response; rebuilt at most once a second
+_health_cache = (0, b'')
+
 @app.route('/api/health', methods=['GET'])
 def health_check():
-    return jsonify({
-        'status': 'healthy',
-        'timestamp': datetime.now().isoformat()
-    }), 200
+    global _health_cache
+    now = int(time.time())
+    if now != _health_cache[0]:
+        _health_cache = (now, orjson.dumps({
+            'status': 'healthy',
+            'timestamp': datetime.fromtimestamp(now, timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+        }))
+    return app.response_class(_health_cache[1], mimetype='application/json')
+
+# The root payload never changes, so serialize it once
+ROOT_BYTES = orjson.dumps({
+    'message': 'Lytir.io API',
+    'version': '1.0.0',
+    'endpoints': {
+        'auth': ['/api/signup', '/api/login', '/api/logout'],
+        'user': ['/api/user', '/api/user/forecasts'],
+        'markets': ['/api/markets', '/api/markets/<id>'],
+        'forecast': ['/api/forecast', '/api/forecast/<idempotency_key>'],
+        'leaderboard': ['/api/leaderboard']
+    }
+})
 
 @app.route('/', methods=['GET'])
 def root():
-    return jsonify({
-        'message': 'Lytir.io API',
-        'version': '1.0.0',
-        'endpoints': {
-            'auth': ['/api/signup', '/api/login', '/api/logout'],
-            'user': ['/api/user', '/api/user/forecasts'],
-            'markets': ['/api/markets', '/api/markets/<id>'],
-            'forecast': ['/api/forecast'],
-            'leaderboard': ['/api/leaderboard']
-        }
-    }), 200
+    return app.response_class(ROOT_BYTES, mimetype='application/json')
 
 # ========================================
 # RUN SERVER
 # ========================================
 
+# Production: gunicorn app:app (settings in gunicorn.conf.py)
+# The block below runs Flask's single-process server for local development only
+
 if __name__ == '__main__':
     init_db()
     # Use 0.0.0.0 for deployment, localhost for local development
     # Change port if needed (default 5001)
-    app.run(host='0.0.0.0', port=5001, debug=True)
+    app.run(host='0.0.0.0', port=5001, debug=False)
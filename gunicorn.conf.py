@@ -0,0 +1,18 @@
+"""
+Gunicorn configuration for the Lytir.io API
+Run from the project root with: gunicorn app:app
+"""
+
+import os
+import subprocess
+import sys
+
+bind = os.environ.get('BIND', '0.0.0.0:5001')
+workers = int(os.environ.get('WEB_CONCURRENCY', 4))
+worker_class = 'gevent'
+worker_connections = 1000
+
+def on_starting(server):
+    # Create the schema in a child process so the master never imports the app;
+    # workers must not inherit its SQLite connections across fork
+    subprocess.run([sys.executable, '-c', 'from app import init_db; init_db()'], check=True)